@@ -157,13 +157,17 @@ class Requantizer:
 
   def _change_tensor_activation_type(self):
     """Change all remaining tensor types from int8 to int16"""
+    int8_type = requantize_flatbuffer_utils.TENSOR_TYPE_CODE[np.int8]
+    activation_tensors = []
     for subgraph in self.model.subgraphs:
       for tensor in subgraph.tensors:
-        if ((tensor in self.remaining_tensors)
-            and (requantize_flatbuffer_utils.TENSOR_CODE_TYPE[tensor.type]
-                 == np.int8) and ("const" not in str(tensor.name))):
-          requantize_flatbuffer_utils.change_activation_tensor_8to16(tensor)
-          self._remove_tensor(tensor)
+        if ((tensor in self.remaining_tensors) and (tensor.type == int8_type)
+            and ("const" not in str(tensor.name))):
+          activation_tensors.append(tensor)
+    requantize_flatbuffer_utils.requantize_all_activations_8to16(
+        activation_tensors)
+    for tensor in activation_tensors:
+      self._remove_tensor(tensor)
 
   def requantize_8to16(self):
     '''
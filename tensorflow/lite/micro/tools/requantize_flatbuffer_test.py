@@ -12,7 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # =============================================================================
+import concurrent.futures
 import os
+from unittest import mock
 
 import numpy as np
 import tensorflow as tf
@@ -20,7 +22,9 @@ import tensorflow as tf
 from tensorflow.python.framework import test_util
 from tensorflow.python.platform import test
 from tflite_micro.tensorflow.lite.micro.tools import requantize_flatbuffer
+from tflite_micro.tensorflow.lite.micro.tools import requantize_flatbuffer_utils
 from tflite_micro.tensorflow.lite.micro.python.interpreter.src import tflm_runtime
+from tflite_micro.tensorflow.lite.python import schema_py_generated
 from tflite_micro.tensorflow.lite.tools import flatbuffer_utils
 
 
@@ -76,6 +80,102 @@ def convert_8to16_requantizer(keras_model, representative_dataset_gen):
   return flatbuffer_utils.convert_object_to_bytearray(requantizer.model)
 
 
+def create_lstm_model_object(num_units):
+  '''Create an int8 model object with a single unidirectional sequence lstm op
+
+  Only the tensors read by the requantizer are set. Indices are from
+  tensorflow/lite/micro/kernels/lstm_shared.h
+  '''
+  np.random.seed(42)
+  model = schema_py_generated.ModelT()
+  empty_buffer = schema_py_generated.BufferT()
+  model.buffers = [empty_buffer]
+  subgraph = schema_py_generated.SubGraphT()
+  subgraph.tensors = []
+
+  def add_tensor(name, tensor_type, scale, zero_point, data=None):
+    tensor = schema_py_generated.TensorT()
+    tensor.name = name
+    tensor.type = tensor_type
+    tensor.buffer = 0
+    if data is not None:
+      buffer = schema_py_generated.BufferT()
+      buffer.data = np.frombuffer(data.tobytes(), dtype=np.uint8)
+      model.buffers.append(buffer)
+      tensor.buffer = len(model.buffers) - 1
+    tensor.quantization = schema_py_generated.QuantizationParametersT()
+    tensor.quantization.scale = [scale]
+    tensor.quantization.zeroPoint = [zero_point]
+    subgraph.tensors.append(tensor)
+    return len(subgraph.tensors) - 1
+
+  int8 = schema_py_generated.TensorType.INT8
+  int32 = schema_py_generated.TensorType.INT32
+  op = schema_py_generated.OperatorT()
+  op.inputs = [-1] * 24
+  op.inputs[0] = add_tensor("input", int8, 0.02, 3)
+  for i in range(1, 9):
+    op.inputs[i] = add_tensor(f"weight_{i}", int8, 0.01 * i, 0)
+  for i in range(12, 16):
+    bias_data = np.random.randint(-2**20, 2**20, num_units, dtype=np.int32)
+    op.inputs[i] = add_tensor(f"bias_{i}", int32, 0.0001 * i, 0, bias_data)
+  op.inputs[18] = add_tensor("hidden_state", int8, 0.03, -2)
+  op.outputs = [add_tensor("output", int8, 0.03, -2)]
+  subgraph.operators = [op]
+  model.subgraphs = [subgraph]
+  # Round trip through the flatbuffer so the model looks like one read from
+  # a file, e.g., float32 scales and numpy buffer data
+  return flatbuffer_utils.convert_bytearray_to_object(
+      flatbuffer_utils.convert_object_to_bytearray(model))
+
+
+class LstmBiasRequantizeTest(test_util.TensorFlowTestCase):
+
+  def _check_requantized_biases(self, num_units):
+    model = create_lstm_model_object(num_units)
+    tensors = model.subgraphs[0].tensors
+    op = model.subgraphs[0].operators[0]
+    original_biases = {}
+    for i in range(12, 16):
+      bias = tensors[op.inputs[i]]
+      original_biases[i] = (model.buffers[bias.buffer].data.view(np.int32),
+                            bias.quantization.scale[0])
+
+    requantize_flatbuffer_utils.requantize_unidirectional_sequence_lstm(
+        tensors, model.buffers, op)
+    input_scale = tensors[op.inputs[0]].quantization.scale[0]
+    packed_model = flatbuffer_utils.convert_bytearray_to_object(
+        flatbuffer_utils.convert_object_to_bytearray(model))
+    packed_tensors = packed_model.subgraphs[0].tensors
+
+    for weight_id, bias_id in zip(range(1, 5), range(12, 16)):
+      bias = packed_tensors[op.inputs[bias_id]]
+      self.assertEqual(bias.type, schema_py_generated.TensorType.INT64)
+      data, scale = original_biases[bias_id]
+      new_scale = (input_scale *
+                   tensors[op.inputs[weight_id]].quantization.scale[0])
+      expected = requantize_flatbuffer_utils.quantize_data(
+          requantize_flatbuffer_utils.dequantize_data(data, scale), new_scale,
+          0, 64).astype(np.int64)
+      self.assertAllEqual(
+          packed_model.buffers[bias.buffer].data.view(np.int64), expected)
+
+  def testSerialConversion(self):
+    with mock.patch("concurrent.futures.ThreadPoolExecutor",
+                    wraps=concurrent.futures.ThreadPoolExecutor) as executor:
+      self._check_requantized_biases(num_units=20)
+    executor.assert_not_called()
+
+  def testConcurrentConversion(self):
+    # Lower the size threshold to use the thread pool for small biases
+    with mock.patch.object(requantize_flatbuffer_utils,
+                           "_MIN_CONCURRENT_BIAS_BYTES", 0):
+      with mock.patch("concurrent.futures.ThreadPoolExecutor",
+                      wraps=concurrent.futures.ThreadPoolExecutor) as executor:
+        self._check_requantized_biases(num_units=20)
+    executor.assert_called_once()
+
+
 class SimpleFCModelTest(test_util.TensorFlowTestCase):
 
   def testCompareWithStandardConversion(self):
@@ -111,5 +211,50 @@ class SimpleFCModelTest(test_util.TensorFlowTestCase):
       )  # can not be the same since int8 model loses some range information
 
 
+class RequantizeUtilsTest(test_util.TensorFlowTestCase):
+
+  def testRequantizeMatchesDequantizeQuantize(self):
+    np.random.seed(42)
+    for _ in range(100):
+      # Flatbuffer scales are float32
+      scale = np.float32(np.random.uniform(1e-6, 1e-3))
+      new_scale = np.float32(np.random.uniform(1e-7, 1e-3))
+      data = np.random.randint(-2**31, 2**31 - 1, size=50, dtype=np.int32)
+
+      expected = requantize_flatbuffer_utils.quantize_data(
+          requantize_flatbuffer_utils.dequantize_data(data, scale), new_scale,
+          0, 64).astype(np.int64)
+      requantized = requantize_flatbuffer_utils._requantize(
+          data, scale, 0, new_scale, 0, 64)
+      self.assertEqual(requantized.dtype, np.int64)
+      self.assertAllEqual(requantized, expected)
+
+  def testRequantizeSaturatesInt64(self):
+    data = np.array([2**31 - 1, -2**31, 5, -5], dtype=np.int32)
+    # 2**31 * 1e10 is out of the int64 range
+    requantized = requantize_flatbuffer_utils._requantize(
+        data, 1e10, 0, 1.0, 0, 64)
+    self.assertEqual(requantized.dtype, np.int64)
+    # Largest float64 below 2**63, 2**63 - 1 itself is not representable
+    self.assertEqual(requantized[0], 2**63 - 1024)
+    self.assertEqual(requantized[1], -2**63)
+    self.assertAllEqual(requantized[2:], [5 * 10**10, -5 * 10**10])
+
+  def testClipRange(self):
+    self.assertAllEqual(
+        requantize_flatbuffer_utils.clip_range(np.array([300., -300., 5.]), 8),
+        [127, -128, 5])
+    # Bit widths without a precomputed range
+    self.assertAllEqual(
+        requantize_flatbuffer_utils.clip_range(np.array([30., -30.]), 4),
+        [7, -8])
+
+  def testQuantizeData(self):
+    self.assertAllEqual(
+        requantize_flatbuffer_utils.quantize_data(np.array([3.3, -100., 100.]),
+                                                  0.5, 1), [8, -128, 127])
+    self.assertEqual(requantize_flatbuffer_utils.quantize_data(3.3, 0.5), 7.0)
+
+
 if __name__ == "__main__":
   test.main()
@@ -12,6 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # =============================================================================
+import concurrent.futures
+
 import numpy as np
 from absl import logging
 from tflite_micro.tensorflow.lite.python.schema_py_generated import TensorType
@@ -40,10 +42,48 @@ TENSOR_CODE_TYPE = {
 }
 
 # TODO(b/269487423): use a common util function instead
-TENSOR_TYPE_CODE = dict((reversed(item) for item in TENSOR_CODE_TYPE.items()))
+# Types without a numpy equivalent are only string placeholders, leave them out
+TENSOR_TYPE_CODE = {
+    v: k
+    for k, v in TENSOR_CODE_TYPE.items() if isinstance(v, type)
+}
+
+# Type codes used while converting tensors
+_TT_INT8 = TENSOR_TYPE_CODE[np.int8]
+_TT_INT16 = TENSOR_TYPE_CODE[np.int16]
+_TT_INT64 = TENSOR_TYPE_CODE[np.int64]
+
+# Value range of a signed integer with the given bit width
+_BIT_RANGES = {
+    8: (-2**7, 2**7 - 1),
+    16: (-2**15, 2**15 - 1),
+    32: (-2**31, 2**31 - 1),
+    64: (-2**63, 2**63 - 1),
+}
+
+# int64 range bounds exactly representable in float64. 2**63 - 1 rounds up to
+# 2**63 as a float, which overflows when cast back to int64
+_INT64_MIN_FLOAT = float(-2**63)
+_INT64_MAX_FLOAT = float(np.nextafter(2.0**63, 0))
 
+# Reciprocal of the int16 qmax. Narrow range (-min == max) is used for
+# symmetrical quantization
+_INV_32767 = 1.0 / 32767
 
-def clip_range(vals, bit_width):
+# Total bias buffer size (in bytes) from which the biases of an op are
+# converted concurrently. Below it, starting a thread pool costs more than the
+# conversion
+_MIN_CONCURRENT_BIAS_BYTES = 1 << 18
+
+
+def _bit_range(bit_width):
+  """Value range of a signed integer with the given bit width"""
+  if bit_width in _BIT_RANGES:
+    return _BIT_RANGES[bit_width]
+  return -2**(bit_width - 1), 2**(bit_width - 1) - 1
+
+
+def clip_range(vals, bit_width, out=None):
   """Mimic integer calculation.
 
   Clip the range of vals based on bit width.
@@ -53,16 +93,14 @@ def clip_range(vals, bit_width):
   Args:
       vals (np.array): float representation of the integer values
       bit_width (int): number of desired bits for vals
+      out (np.array): optional array to store the result in, may be vals
 
   Returns:
       np.array : clipped vals
   """
   # Numpy integer calculation does not do saturation. Implement here
-  min_val = -2**(bit_width - 1)
-  max_val = 2**(bit_width - 1) - 1
-  if vals.max() > max_val or vals.min() < min_val:
-    logging.info(f"WARNING: integer overflow!")
-  return np.clip(vals, min_val, max_val)
+  min_val, max_val = _bit_range(bit_width)
+  return np.clip(vals, min_val, max_val, out=out)
 
 
 def quantize_data(data, scale, zero_point=0, bit_width=8):
@@ -81,8 +119,16 @@ def quantize_data(data, scale, zero_point=0, bit_width=8):
   Returns:
       np.array : quantized data in float but clipped range
   """
-  vals = np.round(data / scale) + zero_point
-  return clip_range(vals, bit_width)
+  # Round and shift in place to avoid allocating a temporary for each step.
+  # Multiplying by the reciprocal is cheaper than an elementwise division. The
+  # reciprocal is computed in float64 since flatbuffer scales are float32
+  vals = np.multiply(data, 1.0 / float(scale))
+  if np.ndim(vals) == 0:
+    # Scalars can not be written in place
+    return clip_range(np.rint(vals) + zero_point, bit_width)
+  np.rint(vals, out=vals)
+  vals += zero_point
+  return clip_range(vals, bit_width, out=vals)
 
 
 def dequantize_data(quantized_data, scale, zero_point=0):
@@ -99,37 +145,118 @@ def dequantize_data(quantized_data, scale, zero_point=0):
   return scale * (quantized_data - zero_point)
 
 
-def change_quantization_settings_8to16(tensor):
-  """Change the quantization seeting of the tensor from int8 to int16"""
+def _requantize(data, scale, zero_point, new_scale, new_zero_point, bit_width):
+  """Requantize integer data to a new scale and zero point.
+
+  Same as quantize_data(dequantize_data(data, scale, zero_point), new_scale,
+  new_zero_point, bit_width) cast to an integer type, but rescales by the
+  ratio of the scales in a single pass over one float buffer.
+
+  Args:
+      data (np.array): integer quantized data
+      scale (float): quantization scale of data
+      zero_point (integer): quantization zero point of data
+      new_scale (float): quantization scale to requantize to
+      new_zero_point (integer): quantization zero point to requantize to
+      bit_width (int): number of bits of the requantized integer type
+
+  Returns:
+      np.array : requantized data with integer type of bit_width bits
+  """
+  # Scales unpacked from a flatbuffer are float32, compute the ratio in float64
+  # to keep the precision of rescaling through the float representation
+  ratio = float(scale) / float(new_scale)
+  if zero_point != 0:
+    vals = np.subtract(data, zero_point, dtype=np.float64)
+    vals *= ratio
+  else:
+    # Widen and rescale in a single ufunc call
+    vals = np.multiply(data, ratio, dtype=np.float64)
+  np.rint(vals, out=vals)
+  if new_zero_point != 0:
+    vals += new_zero_point
+
+  min_val, max_val = _bit_range(bit_width)
+  # Only saturate when some value of the input type can leave the range, e.g.,
+  # int32 data scaled down can not overflow int64
+  data_range = np.iinfo(data.dtype)
+  max_abs_val = (
+      max(data_range.max - zero_point, zero_point - data_range.min) * ratio +
+      abs(new_zero_point))
+  if max_abs_val >= max_val:
+    if bit_width == 64:
+      min_val, max_val = _INT64_MIN_FLOAT, _INT64_MAX_FLOAT
+    np.clip(vals, min_val, max_val, out=vals)
+  return vals.astype(np.dtype(f"int{bit_width}"))
+
+
+def _scale_8to16(scale, zero_point):
+  """Compute the symmetrical int16 scale of int8 quantized values.
+
+  Works on scalars as well as arrays of scales and zero points.
+  """
+  # Set MAX_INT8 from 127 to 128 to compromise the range precision loss due to int8 quantization
+  MAX_INT8 = 128
 
+  # Asymmertical quantized: rmax = scale * (MAX_INT8 - zero_point) and
+  # rmin = scale * (-MAX_INT8 - zero_point), so max(|rmax|, |rmin|) is
+  # scale * (MAX_INT8 + |zero_point|)
+  # symmertical quantized: scale * qmax = rmax
+  return scale * (MAX_INT8 + np.abs(zero_point)) * _INV_32767
+
+
+def _check_layer_quantization(tensor):
   if (tensor.quantization.quantizedDimension != 0):
     raise RuntimeError(
         "Only layer level quantization is supported. Per channel quantization is not supported now"
     )
 
-  scale = tensor.quantization.scale[0]
-  zero_point = tensor.quantization.zeroPoint[0]
 
-  # Set MAX_INT8 from 127 to 128 to compromise the range precision loss due to int8 quantization
-  MIN_INT8, MAX_INT8 = -128, 128
-  # Narrow range (-min == max) is used for symmetrical quantization
-  MIN_INT16, MAX_INT16 = -32767, 32767
+def change_quantization_settings_8to16(tensor):
+  """Change the quantization seeting of the tensor from int8 to int16"""
+  _check_layer_quantization(tensor)
 
-  # Asymmertical quantized: scale * (qmax - zero_point) = rmax
-  rmax = scale * (MAX_INT8 - zero_point)
-  rmin = scale * (MIN_INT8 - zero_point)
-  # symmertical quantized: scale * qmax = rmax
-  scale_16 = max(abs(rmax), abs(rmin)) / abs(MIN_INT16)
+  scale = tensor.quantization.scale[0]
+  zero_point = tensor.quantization.zeroPoint[0]
   # Change scale: Symmetrical Quantized
-  tensor.quantization.scale = [scale_16]
+  tensor.quantization.scale = [float(_scale_8to16(scale, zero_point))]
   tensor.quantization.zeroPoint = [0]
 
 
 def change_activation_tensor_8to16(tensor):
   """Change the quantization setting of a activation tensor from int8 to int16"""
-  if tensor.type == TENSOR_TYPE_CODE[np.int8]:
-    change_quantization_settings_8to16(tensor)
-    tensor.type = TENSOR_TYPE_CODE[np.int16]
+  # Activations shared between ops are visited more than once, nothing to do
+  # if the tensor has already been converted
+  if tensor.type != _TT_INT8:
+    return
+  change_quantization_settings_8to16(tensor)
+  tensor.type = _TT_INT16
+  logging.info(f"Set {tensor.name} from int8 to int16 ")
+
+
+def requantize_all_activations_8to16(tensors):
+  """Change the quantization setting of activation tensors from int8 to int16
+
+  Same as calling change_activation_tensor_8to16 on each tensor, but the new
+  scales are computed for all tensors at once.
+
+  Args:
+      tensors (list): activation tensors, the ones not of int8 type are skipped
+  """
+  int8_tensors = [tensor for tensor in tensors if tensor.type == _TT_INT8]
+  if not int8_tensors:
+    return
+  for tensor in int8_tensors:
+    _check_layer_quantization(tensor)
+
+  scales = np.array([tensor.quantization.scale[0] for tensor in int8_tensors])
+  zero_points = np.array(
+      [tensor.quantization.zeroPoint[0] for tensor in int8_tensors])
+  scales_16 = _scale_8to16(scales, zero_points).tolist()
+  for tensor, scale_16 in zip(int8_tensors, scales_16):
+    tensor.quantization.scale = [scale_16]
+    tensor.quantization.zeroPoint = [0]
+    tensor.type = _TT_INT16
     logging.info(f"Set {tensor.name} from int8 to int16 ")
 
 
@@ -145,16 +272,22 @@ def set_bias_type_int64(buffers, input, weight, bias):
   bias_buffer = buffers[bias.buffer]
   bias_scale = bias.quantization.scale[0]
   bias_zero_pt = bias.quantization.zeroPoint[0]
-  data = np.frombuffer(bias_buffer.data, dtype=np.int32)
-  dequantized_data = dequantize_data(data, bias_scale, bias_zero_pt)
+  # Buffer data unpacked from a flatbuffer is usually a uint8 numpy array
+  # already, reinterpret it without wrapping it in a new buffer
+  if isinstance(bias_buffer.data, np.ndarray):
+    data = bias_buffer.data.view(np.int32)
+  else:
+    data = np.frombuffer(bias_buffer.data, dtype=np.int32)
   bias_scale_int64 = (input.quantization.scale[0] *
                       weight.quantization.scale[0])
   bias_zero_pt_int64 = 0  # symmetrical quantized
-  int64_data = quantize_data(dequantized_data, bias_scale_int64,
-                             bias_zero_pt_int64, 64).astype(np.int64)
-  bias_buffer.data = int64_data.tobytes()
+  int64_data = _requantize(data, bias_scale, bias_zero_pt, bias_scale_int64,
+                           bias_zero_pt_int64, 64)
+  # Buffer data is a uint8 vector. A numpy array is serialized in one copy by
+  # the flatbuffer builder, unlike bytes which are packed byte by byte
+  bias_buffer.data = int64_data.view(np.uint8)
 
-  bias.type = TENSOR_TYPE_CODE[np.int64]
+  bias.type = _TT_INT64
   bias.quantization.scale = [bias_scale_int64]
   bias.quantization.zeroPoint = [bias_zero_pt_int64]
   logging.info(f"Set {bias.name} from int32 to int64")
@@ -184,21 +317,34 @@ def requantize_unidirectional_sequence_lstm(tensors, buffers, op):
 
   # Indices are from tensorflow/lite/micro/kernels/lstm_shared.h
   input_weights_idx = [1, 2, 3, 4]
-  recurrent_weights_idx = [5, 6, 7, 8]
+  # Recurrent weights (5 to 8) stay the same and have no associated biases
   bias_idx = [12, 13, 14, 15]
 
   change_activation_tensor_8to16(input_tensor)
   change_activation_tensor_8to16(hidden_state_tensor)
   change_activation_tensor_8to16(output_tensor)
 
-  for weight_id, bias_id in zip(input_weights_idx, bias_idx):
-    weight_tensor = tensors[op.inputs[weight_id]]
-    bias_tensor = tensors[op.inputs[bias_id]]
-    set_bias_type_int64(buffers, input_tensor, weight_tensor, bias_tensor)
-
-  # recurrent weights have no associated biases
-  for weight_id in recurrent_weights_idx:
-    weight_tensor = tensors[op.inputs[weight_id]]
+  weight_tensors = [tensors[op.inputs[i]] for i in input_weights_idx]
+  bias_tensors = [tensors[op.inputs[i]] for i in bias_idx]
+
+  # Gate biases are independent of each other. Numpy releases the GIL while
+  # rescaling, so large ones can be converted concurrently. Small biases are
+  # converted in place since the thread pool overhead would dominate
+  biases_size = sum(len(buffers[bias.buffer].data) for bias in bias_tensors)
+  if biases_size < _MIN_CONCURRENT_BIAS_BYTES:
+    for weight, bias in zip(weight_tensors, bias_tensors):
+      set_bias_type_int64(buffers, input_tensor, weight, bias)
+  else:
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=len(bias_tensors)) as executor:
+      futures = [
+          executor.submit(set_bias_type_int64, buffers, input_tensor, weight,
+                          bias)
+          for weight, bias in zip(weight_tensors, bias_tensors)
+      ]
+    # Propagate any conversion error
+    for future in futures:
+      future.result()
 
 
 def requantize_softmax(tensors, buffers, op):
@@ -210,10 +356,10 @@ def requantize_softmax(tensors, buffers, op):
   change_activation_tensor_8to16(input_tensor)
 
   # Output range is always [0,1]
-  if output_tensor.type == TENSOR_TYPE_CODE[np.int8]:
+  if output_tensor.type == _TT_INT8:
     # change quantization settings
     output_tensor.quantization.scale = [1 / 32768]
     output_tensor.quantization.zeroPoint = [0]
     # Set tensor type
-    output_tensor.type = TENSOR_TYPE_CODE[np.int16]
+    output_tensor.type = _TT_INT16
     logging.info(f"Set {output_tensor.name} from int8 to int16 ")